@@ -1,2 +1,11 @@
 from .agent import Agent, RandomAgent, WalkThroughAgent
-from .llm import LLMAgent
+
+
+def __getattr__(name):
+    # The LLM agent pulls in the HTTP client libraries, so it is only imported when
+    # it is first accessed
+    if name in ("BatchLLMDriver", "LLMAgent"):
+        from . import llm
+
+        return getattr(llm, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
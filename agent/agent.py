@@ -28,6 +28,11 @@ class Agent:
         self.env = env
         self.max_steps = max_steps
 
+        # Intern table of the observations seen so far, so that repeated observations
+        # can be referred to by an integer id instead of the (long) text itself
+        self._obs_intern: dict[str, int] = {}
+        self._obs_by_id: list[str] = []
+
         self.reset_env()
 
     def reset_env(self):
@@ -35,12 +40,32 @@ class Agent:
         Resets the environment and the agent's internal state.
         """
         self.step = 0
-        self.observations = {}
-        self.actions = {}
-        self.rewards = {}
+        self.observations = []
+        self.actions = []
+        self.rewards = []
 
         observation, info = self.env.reset()
-        self.observations[self.step] = observation  # Add the first observation
+        self._previous_observation_id = None
+        self._observation_id = self._intern_observation(observation)
+        self.observations.append(observation)  # Add the first observation
+        self.info = info
+
+    def _intern_observation(self, observation: str) -> int:
+        """
+        Returns the id of the observation, adding it to the intern table if it has
+        not been seen before.
+
+        Args:
+            observation (str): The observation.
+
+        Returns:
+            int: The id of the observation.
+        """
+        observation_id = self._obs_intern.setdefault(observation, len(self._obs_by_id))
+        if observation_id == len(self._obs_by_id):
+            self._obs_by_id.append(observation)
+
+        return observation_id
 
     def choose_action(self, valid_actions: list[str]) -> str:
         """
@@ -69,7 +94,7 @@ class Agent:
         Args:
             action (str): The chosen action.
         """
-        self.actions[self.step] = action
+        self.actions.append(action)
 
     def update_reward(self, reward: float) -> None:
         """
@@ -78,7 +103,7 @@ class Agent:
         Args:
             reward (float): The reward received after taking the action.
         """
-        self.rewards[self.step] = reward
+        self.rewards.append(reward)
 
     def update_observation(self, observation: str) -> None:
         """
@@ -87,7 +112,44 @@ class Agent:
         Args:
             observation (str): The observation after taking the action.
         """
-        self.observations[self.step] = observation
+        self._previous_observation_id = self._observation_id
+        self._observation_id = self._intern_observation(observation)
+        self.observations.append(observation)
+
+    def take_action(self, action: str) -> bool:
+        """
+        Takes an action in the environment and updates the agent's internal state.
+
+        Args:
+            action (str): The action to take.
+
+        Returns:
+            bool: Whether the episode is done.
+        """
+        observation, reward, done, info = self.env.step(action)
+        self.record_step(action, observation, reward, info)
+
+        return done
+
+    def record_step(
+        self, action: str, observation: str, reward: float, info: dict
+    ) -> None:
+        """
+        Updates the agent's internal state with a step taken in the environment.
+
+        Args:
+            action (str): The action that was taken.
+            observation (str): The observation after taking the action.
+            reward (float): The reward received after taking the action.
+            info (dict): The info returned by the environment.
+        """
+        self.update_action(action)
+
+        self.step += 1
+
+        self.update_reward(reward)
+        self.update_observation(observation)
+        self.info = info
 
     def run(self) -> None:
         """
@@ -100,16 +162,8 @@ class Agent:
                 print("No valid actions left. Ending episode.")
                 break
             action = self.choose_action(valid_actions)
-            self.update_action(action)
+            done = self.take_action(action)
 
-            observation, reward, done, info = self.env.step(action)
-
-            self.step += 1
-
-            self.update_reward(reward)
-            self.update_observation(observation)
-
-        self.info = info
         self.close_env()
 
 
@@ -134,18 +188,9 @@ class WalkThroughAgent(Agent):
         """
         Runs the agent in the environment.
         """
-        done = False
         for action in self.env.get_walkthrough():
-            self.update_action(action)
+            self.take_action(action)
 
-            observation, reward, done, info = self.env.step(action)
-
-            self.step += 1
-
-            self.update_reward(reward)
-            self.update_observation(observation)
-
-        self.info = info
         self.close_env()
 
 
@@ -1,11 +1,79 @@
-import json
+import asyncio
+import collections
 import random
 import re
-from typing import Any
+from functools import lru_cache
+from typing import Any, Callable
+import aiohttp
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .agent import Agent
 
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+ACTION_CACHE_SIZE = 1024
+
+# Connecting should be quick, while generating a response may take a while. The
+# connect timeout is slightly larger than a multiple of 3 s, the TCP retransmission
+# window.
+CONNECT_TIMEOUT = 3.05
+
+# Rate limiting and transient server errors are retried with exponential backoff,
+# instead of immediately falling back to a random action.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+RETRY_BACKOFF_FACTOR = 0.5
+# Longest Retry-After delay honoured, in seconds, so that a misbehaving server
+# cannot stall an agent indefinitely.
+MAX_RETRY_AFTER = 60
+
+
+@lru_cache(maxsize=1024)
+def _compile_action_pattern(valid_actions: frozenset[str]) -> re.Pattern:
+    """
+    Compiles a single case-insensitive regex that matches any of the valid actions.
+
+    Jericho often returns the same set of valid actions in a given room, so the
+    compiled patterns are cached by action set. Longer actions come first in the
+    alternation, so that e.g. "take lamp" wins over "take" at the same position.
+
+    Args:
+        valid_actions (frozenset[str]): The valid actions.
+
+    Returns:
+        re.Pattern: The compiled pattern. Group 1 holds the matched action.
+    """
+    actions = sorted(valid_actions, key=lambda action: (-len(action), action))
+    return re.compile(
+        r"\b(" + "|".join(map(re.escape, actions)) + r")\b", re.IGNORECASE
+    )
+
+
+def _with_cache_control(role: str, content: str) -> dict[str, Any]:
+    """
+    Returns a chat message marked as a prompt caching breakpoint.
+
+    Args:
+        role (str): The role of the message.
+        content (str): The plain text content of the message.
+
+    Returns:
+        dict[str, Any]: The message with its content as a text part that carries
+            an ephemeral cache_control tag.
+    """
+    return {
+        "role": role,
+        "content": [
+            {
+                "type": "text",
+                "text": content,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
+    }
+
 
 class LLMAgent(Agent):
     """
@@ -25,6 +93,8 @@ class LLMAgent(Agent):
         max_chat_history_size: int = 10,
         fallback_to_random: bool = True,
         timeout: int = 10,
+        use_action_cache: bool = False,
+        max_archived_observation_length: int | None = 400,
     ) -> None:
         """
         Initialize the LLM-based agent.
@@ -37,11 +107,25 @@ class LLMAgent(Agent):
             env (Any): The game environment object.
             max_steps (int | None): Maximum number of steps to take before terminating.
             max_chat_history_size (int): Maximum number of conversation turns to keep in
-                history.
+                history. Must be at least 1, since the current observation is only
+                sent as part of the history.
             fallback_to_random (bool): Whether to choose a random action when the LLM
                 fails.
-            timeout (int): HTTP request timeout in seconds.
+            timeout (int): HTTP read timeout in seconds.
+            use_action_cache (bool): Whether to reuse the action the LLM chose the
+                last time the same transition led to the same observation with the
+                same valid actions, instead of asking the LLM again. Each cached
+                action is served at most once, so the cache alone cannot keep the
+                agent in a loop. The cached action ignores the rest of the chat
+                history, so this trades evaluation fidelity for fewer API calls.
+            max_archived_observation_length (int | None): Number of characters that
+                observations are cut down to in the chat history once they are no
+                longer the current observation. If None, they are kept in full.
         """
+        if max_chat_history_size < 1:
+            raise ValueError(
+                f"max_chat_history_size must be at least 1, got {max_chat_history_size}"
+            )
         super().__init__(env, max_steps)
         self.api_key = api_key
         self.model = model
@@ -49,7 +133,45 @@ class LLMAgent(Agent):
         self.max_chat_history_size = max_chat_history_size
         self.fallback_to_random = fallback_to_random
         self.timeout = timeout
-        self.info: dict[str, Any] = {}
+        self.use_action_cache = use_action_cache
+        self.max_archived_observation_length = max_archived_observation_length
+
+        # Cache of (previous observation id, previous action, observation id,
+        # valid actions) -> action chosen by the LLM
+        self._action_cache: collections.OrderedDict[
+            tuple[int | None, str | None, int, tuple[str, ...]], str
+        ] = collections.OrderedDict()
+        # Keys whose cached action has already been served once
+        self._served_cache_keys: set[
+            tuple[int | None, str | None, int, tuple[str, ...]]
+        ] = set()
+
+        # The request body is serialized by hand (see _build_body), so the content
+        # type has to be set explicitly.
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "http://localhost:8888",
+            "X-Title": "Jericho Agent",
+        }
+
+        # Reuse connections across steps instead of a new TCP + TLS handshake per call
+        self._session = requests.Session()
+        self._session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=32,
+                pool_maxsize=64,
+                max_retries=Retry(
+                    total=MAX_RETRIES,
+                    backoff_factor=RETRY_BACKOFF_FACTOR,
+                    status_forcelist=RETRY_STATUSES,
+                    allowed_methods=["POST"],
+                    respect_retry_after_header=True,
+                ),
+            ),
+        )
+        self._session.headers.update(self.headers)
 
         self.system_message = {
             "role": "system",
@@ -71,13 +193,30 @@ class LLMAgent(Agent):
                 "actions list."
             ),
         }
-        self.chat_history: list[dict[str, str]] = [self.system_message]
-        self.chat_history.append(
-            {
-                "role": "user",
-                "content": f"Step: {self.step}: Observation: {self.observations[self.step]}",
-            }
-        )  # Add the first observation
+        # Anthropic models only cache prompts up to explicit breakpoints
+        self._use_cache_control = self.model.startswith("anthropic/")
+
+        # The model, the system message and every history message are serialized
+        # to JSON only once, and joined into the request body at each step.
+        self._model_json = orjson.dumps(self.model)
+        self._system_message_json = orjson.dumps(
+            _with_cache_control(**self.system_message)
+            if self._use_cache_control
+            else self.system_message
+        )
+
+        # The system message is kept outside the history, so that the oldest turns
+        # can be evicted by the deque itself.
+        # History messages are kept as (role, content) tuples. They are only turned
+        # into message dicts to be serialized, once, in _append_to_history.
+        self.chat_history: collections.deque[tuple[str, str]] = collections.deque(
+            maxlen=self.max_chat_history_size * 3
+        )
+        self._chat_history_json: collections.deque[bytes] = collections.deque(
+            maxlen=self.max_chat_history_size * 3
+        )
+        self._observation_message = ("user", "Observation: " + self.observations[-1])
+        self._append_to_history(self._observation_message)  # Add the first observation
 
     def choose_action(
         self,
@@ -89,7 +228,9 @@ class LLMAgent(Agent):
         This method sends the current game state and valid actions to the LLM,
         and extracts a valid action from the LLM's response. If the LLM fails to
         produce a valid action, it will either fall back to choosing a random action
-        or raise an exception based on the fallback_to_random setting.
+        or raise an exception based on the fallback_to_random setting. If
+        use_action_cache is set and the same game state was seen before, the action
+        the LLM chose then is returned without calling the API.
 
         Args:
             valid_actions (list[str]): List of valid actions the agent can take.
@@ -103,61 +244,305 @@ class LLMAgent(Agent):
             requests.exceptions.RequestException: If there's an API communication error
                 and fallback_to_random is False.
         """
-        if len(self.chat_history) > self.max_chat_history_size * 3:
-            self.chat_history = [self.system_message] + self.chat_history[1:][
-                -self.max_chat_history_size * 3 :
-            ]
+        action = self._get_cached_action(valid_actions)
+        if action is not None:
+            return action
 
-        messages = self.chat_history + [
-            {
-                "role": "user",
-                "content": (
-                    f"Current observation: {self.observations[self.step]}\n"
-                    f"Valid actions: {valid_actions}\n"
-                    "Which action do you want to take? Respond with the action only."
-                ),
-            }
-        ]
+        body = self._build_body(valid_actions)
 
         try:
-            response = requests.post(
-                url="https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Content-Type": "application/json",
-                    "HTTP-Referer": "http://localhost:8888",
-                    "X-Title": "Jericho Agent",
-                },
-                data=json.dumps({"model": self.model, "messages": messages}),
-                timeout=self.timeout,
+            response = self._session.post(
+                OPENROUTER_URL, data=body, timeout=(CONNECT_TIMEOUT, self.timeout)
             )
             response.raise_for_status()
-            raw_response = response.json()["choices"][0]["message"]["content"].strip()
+            response_json = orjson.loads(response.content)
+            raw_response = response_json["choices"][0]["message"]["content"].strip()
 
-            # Use regex to find the exact matching valid action
-            for action in valid_actions:
-                if re.search(rf"\b{re.escape(action)}\b", raw_response, re.IGNORECASE):
-                    return action
+            return self._parse_response(raw_response, valid_actions)
 
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            print(f"Error calling OpenRouter API: {e}")
             if self.fallback_to_random:
-                print(
-                    f"No valid action found in LLM response. Using random action. "
-                    f"Response: {raw_response}"
-                )
                 return random.choice(valid_actions)
             else:
-                raise ValueError(
-                    f"No valid action found in LLM response and fallback_to_random is "
-                    f"False. Raw response: {raw_response}"
-                )
+                raise
 
-        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+    async def achoose_action(
+        self,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        valid_actions: list[str],
+    ) -> str:
+        """
+        Asynchronous counterpart of choose_action.
+
+        The request is sent through a shared aiohttp session so that many agents can
+        wait on the API at the same time. The semaphore caps the number of requests
+        in flight across all agents, so that the provider's rate limit is respected.
+
+        Args:
+            session (aiohttp.ClientSession): The shared HTTP session.
+            semaphore (asyncio.Semaphore): Limits the number of concurrent requests.
+            valid_actions (list[str]): List of valid actions the agent can take.
+
+        Returns:
+            str: The selected action to perform.
+
+        Raises:
+            ValueError: If no valid action is found in the LLM response and
+                fallback_to_random is False.
+            aiohttp.ClientError: If there's an API communication error and
+                fallback_to_random is False.
+        """
+        action = self._get_cached_action(valid_actions)
+        if action is not None:
+            return action
+
+        body = self._build_body(valid_actions)
+
+        try:
+            response_json = await self._apost(session, semaphore, body)
+            raw_response = response_json["choices"][0]["message"]["content"].strip()
+
+            return self._parse_response(raw_response, valid_actions)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
             print(f"Error calling OpenRouter API: {e}")
             if self.fallback_to_random:
                 return random.choice(valid_actions)
             else:
                 raise
 
+    async def _apost(
+        self,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        body: bytes,
+    ) -> Any:
+        """
+        Posts the request body to the API and returns the decoded JSON response.
+
+        Like the retries mounted on the requests session, connection errors,
+        timeouts and responses with a status in RETRY_STATUSES are retried with
+        exponential backoff, honouring the Retry-After header (up to
+        MAX_RETRY_AFTER seconds) if the server sends one. The semaphore is only
+        held while a request is in flight, so that an agent waiting to retry does
+        not take a concurrency slot from the others.
+
+        Args:
+            session (aiohttp.ClientSession): The shared HTTP session.
+            semaphore (asyncio.Semaphore): Limits the number of concurrent requests.
+            body (bytes): The request body.
+
+        Returns:
+            Any: The decoded JSON response.
+
+        Raises:
+            aiohttp.ClientResponseError: If the response has an error status, after
+                retrying if the status is retryable.
+            aiohttp.ClientConnectionError: If the connection keeps failing.
+            asyncio.TimeoutError: If the request keeps timing out.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            retry_after = ""
+            try:
+                async with semaphore:
+                    async with session.post(
+                        OPENROUTER_URL, data=body, headers=self.headers
+                    ) as response:
+                        if (
+                            response.status not in RETRY_STATUSES
+                            or attempt == MAX_RETRIES
+                        ):
+                            response.raise_for_status()
+                            return orjson.loads(await response.read())
+
+                        retry_after = response.headers.get("Retry-After", "")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == MAX_RETRIES:
+                    raise
+
+            if retry_after.isdigit():
+                delay = min(float(retry_after), MAX_RETRY_AFTER)
+            else:
+                delay = RETRY_BACKOFF_FACTOR * 2**attempt
+
+            await asyncio.sleep(delay)
+
+    def _action_cache_key(
+        self, valid_actions: list[str]
+    ) -> tuple[int | None, str | None, int, tuple[str, ...]]:
+        """
+        Returns the action cache key of the current game state.
+
+        The key includes the step that led here, so that e.g. the first and the
+        second time "wait" leads to the same room are told apart.
+
+        Args:
+            valid_actions (list[str]): List of valid actions the agent can take.
+
+        Returns:
+            tuple: The previous observation id, the previous action, the current
+                observation id and the valid actions.
+        """
+        return (
+            self._previous_observation_id,
+            self.actions[-1] if self.actions else None,
+            self._observation_id,
+            tuple(valid_actions),
+        )
+
+    def _get_cached_action(self, valid_actions: list[str]) -> str | None:
+        """
+        Looks up the action previously chosen for the current game state.
+
+        Each key is served at most once, after which the LLM is always queried
+        for it. Otherwise, a cycle of states whose actions are all cached, e.g.
+        north and south between two rooms, would be replayed forever without any
+        API call. Nothing is served either when the last action left the
+        observation unchanged, as repeating it could not lead anywhere new.
+
+        Args:
+            valid_actions (list[str]): List of valid actions the agent can take.
+
+        Returns:
+            str | None: The cached action, or None if there is none or the cache is
+                disabled.
+        """
+        if (
+            not self.use_action_cache
+            or self._previous_observation_id == self._observation_id
+        ):
+            return None
+
+        key = self._action_cache_key(valid_actions)
+        action = self._action_cache.pop(key, None)
+        if action is not None:
+            self._served_cache_keys.add(key)
+
+        return action
+
+    def _cache_action(self, valid_actions: list[str], action: str) -> None:
+        """
+        Caches the action chosen by the LLM for the current game state, unless it
+        has been served from the cache before. The oldest entry is evicted when the
+        cache is full.
+
+        Args:
+            valid_actions (list[str]): List of valid actions the agent can take.
+            action (str): The action chosen by the LLM.
+        """
+        if not self.use_action_cache:
+            return
+
+        key = self._action_cache_key(valid_actions)
+        if key in self._served_cache_keys:
+            return
+
+        self._action_cache[key] = action
+        if len(self._action_cache) > ACTION_CACHE_SIZE:
+            self._action_cache.popitem(last=False)
+
+    def _append_to_history(self, message: tuple[str, str]) -> None:
+        """
+        Appends a message to the chat history, together with its JSON serialization.
+
+        Args:
+            message (tuple[str, str]): The role and content of the message.
+        """
+        role, content = message
+        self.chat_history.append(message)
+        self._chat_history_json.append(orjson.dumps({"role": role, "content": content}))
+
+    def _build_body(self, valid_actions: list[str]) -> bytes:
+        """
+        Builds the JSON request body for the current step from the system message,
+        the chat history and the prompt with the valid actions.
+
+        Apart from the previous observation being shortened once, messages in the
+        chat history are never rewritten, so the system message and the history form
+        a prefix that providers can cache between steps. Everything
+        that only applies to the current step goes into the final user message. The
+        current observation is already the last message of the chat history.
+
+        Only the final user message is serialized here. All other messages reuse
+        the JSON that was built when they were added.
+
+        Args:
+            valid_actions (list[str]): List of valid actions the agent can take.
+
+        Returns:
+            bytes: The request body.
+        """
+        messages_json = [self._system_message_json, *self._chat_history_json]
+
+        if self._use_cache_control and self.chat_history:
+            last_message = _with_cache_control(*self.chat_history[-1])
+            messages_json[-1] = orjson.dumps(last_message)
+
+        messages_json.append(
+            orjson.dumps(
+                {
+                    "role": "user",
+                    "content": (
+                        f"Valid actions: {valid_actions}\n"
+                        "Which action do you want to take? Respond with the action "
+                        "only."
+                    ),
+                }
+            )
+        )
+
+        return (
+            b'{"model":'
+            + self._model_json
+            + b',"messages":['
+            + b",".join(messages_json)
+            + b"]}"
+        )
+
+    def _parse_response(self, raw_response: str, valid_actions: list[str]) -> str:
+        """
+        Extracts a valid action from the raw LLM response.
+
+        Args:
+            raw_response (str): The content of the LLM response.
+            valid_actions (list[str]): List of valid actions the agent can take.
+
+        Returns:
+            str: The matched action, or a random one if fallback_to_random is True.
+
+        Raises:
+            ValueError: If no valid action is found and fallback_to_random is False.
+        """
+        # Use regex to find the exact matching valid action
+        pattern = _compile_action_pattern(frozenset(valid_actions))
+        match = pattern.search(raw_response)
+        if match:
+            actions = {action.lower(): action for action in valid_actions}
+            action = actions[match.group(1).lower()]
+            self._cache_action(valid_actions, action)
+            return action
+
+        if self.fallback_to_random:
+            print(
+                f"No valid action found in LLM response. Using random action. "
+                f"Response: {raw_response}"
+            )
+            return random.choice(valid_actions)
+        else:
+            raise ValueError(
+                f"No valid action found in LLM response and fallback_to_random is "
+                f"False. Raw response: {raw_response}"
+            )
+
+    def close_env(self) -> None:
+        """
+        Closes the environment and the HTTP session.
+        """
+        super().close_env()
+        self._session.close()
+
     def update_action(self, action: str) -> None:
         """
         Updates the agent's internal state with the chosen action.
@@ -168,10 +553,8 @@ class LLMAgent(Agent):
         Args:
             action (str): The chosen action.
         """
-        self.actions[self.step] = action
-        self.chat_history.append(
-            {"role": "assistant", "content": f"Step {self.step}: Action: {action}"}
-        )
+        self.actions.append(action)
+        self._append_to_history(("assistant", "Action: " + action))
 
     def update_reward(self, reward: float) -> None:
         """
@@ -183,23 +566,142 @@ class LLMAgent(Agent):
         Args:
             reward (float): The reward received after taking the action.
         """
-        self.rewards[self.step] = reward
+        self.rewards.append(reward)
 
-        self.chat_history.append(
-            {"role": "user", "content": f"Step {self.step}: Reward: {reward}"}
-        )
+        self._append_to_history(("user", "Reward: " + str(reward)))
 
     def update_observation(self, observation: str) -> None:
         """
         Updates the agent's internal state with the received observation.
 
         This method records the observation received after taking an action,
-        and adds it to the chat history for context in future decisions.
+        and adds it to the chat history for context in future decisions. The
+        previous observation in the chat history is shortened, as it is no longer
+        current.
 
         Args:
             observation (str): The observation after taking the action.
         """
-        self.observations[self.step] = observation
-        self.chat_history.append(
-            {"role": "user", "content": f"Step {self.step}: Observation: {observation}"}
+        super().update_observation(observation)
+        self._shorten_previous_observation()
+        self._observation_message = ("user", "Observation: " + observation)
+        self._append_to_history(self._observation_message)
+
+    def _shorten_previous_observation(self) -> None:
+        """
+        Cuts the previous observation in the chat history down to
+        max_archived_observation_length characters.
+
+        Room descriptions can be several kilobytes long, and sending them in full
+        for every turn in the history makes each request grow with the history size.
+        """
+        limit = self.max_archived_observation_length
+        previous_observation = self.observations[-2]
+        if limit is None or len(previous_observation) <= limit:
+            return
+
+        # The action and the reward of this step come after the previous observation
+        index = len(self.chat_history) - 3
+        if index < 0 or self.chat_history[index] is not self._observation_message:
+            return
+
+        content = "Observation: " + previous_observation[:limit] + "…"
+        self.chat_history[index] = ("user", content)
+        self._chat_history_json[index] = orjson.dumps(
+            {"role": "user", "content": content}
         )
+
+
+class BatchLLMDriver:
+    """
+    Plays several LLMAgents in lockstep, one game per agent.
+
+    At every tick, the prompts of all agents whose episodes are still running are
+    sent to the API together, and each response is routed back to the agent that
+    asked for it. The driver owns the HTTP session shared by all agents and a
+    semaphore that limits the number of requests in flight, so that the provider's
+    rate limit is respected.
+    """
+
+    def __init__(self, timeout: int = 10, max_concurrency: int = 16) -> None:
+        """
+        Initialize the driver.
+
+        Args:
+            timeout (int): HTTP read timeout in seconds.
+            max_concurrency (int): Maximum number of requests in flight at once.
+        """
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+
+    async def run(
+        self,
+        agents: list[LLMAgent],
+        vector_env: Any,
+        on_finish: Callable[[int], None] | None = None,
+    ) -> None:
+        """
+        Runs all agents until each of their episodes has ended.
+
+        Within a tick, the environments of all running games are queried and
+        stepped together through vector_env, and the requests to the API are sent
+        together in between.
+
+        Args:
+            agents (list[LLMAgent]): The agents to run.
+            vector_env (VectorFrotzEnv): Wraps the agents' environments, in the same
+                order as agents.
+            on_finish (Callable[[int], None] | None): Called with the index of each
+                agent as soon as its episode has ended and its environment is
+                closed.
+        """
+
+        def finish(index: int) -> None:
+            agents[index].close_env()
+            if on_finish is not None:
+                on_finish(index)
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=CONNECT_TIMEOUT, sock_read=self.timeout
+            ),
+            connector=aiohttp.TCPConnector(limit=64),
+        ) as session:
+            live_indices = list(range(len(agents)))
+            while live_indices:
+                running_indices = []
+                for index in live_indices:
+                    agent = agents[index]
+                    if agent.max_steps and agent.step >= agent.max_steps:
+                        finish(index)
+                    else:
+                        running_indices.append(index)
+
+                ticking_indices = []
+                pending = []
+                for index, valid_actions in zip(
+                    running_indices, vector_env.get_valid_actions(running_indices)
+                ):
+                    if len(valid_actions) == 0:
+                        print("No valid actions left. Ending episode.")
+                        finish(index)
+                        continue
+                    ticking_indices.append(index)
+                    pending.append(
+                        agents[index].achoose_action(session, semaphore, valid_actions)
+                    )
+
+                actions = await asyncio.gather(*pending)
+
+                live_indices = []
+                for index, action, (observation, reward, done, info) in zip(
+                    ticking_indices,
+                    actions,
+                    vector_env.step(ticking_indices, actions),
+                ):
+                    agents[index].record_step(action, observation, reward, info)
+                    if done:
+                        finish(index)
+                    else:
+                        live_indices.append(index)
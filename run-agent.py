@@ -1,8 +1,13 @@
+import asyncio
 import json
 import argparse
-from utils import get_game_paths, create_game
-from tqdm.auto import tqdm
-from agent import RandomAgent, WalkThroughAgent, LLMAgent
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator
+from utils import VectorFrotzEnv, get_game_paths, create_game
+from tqdm import tqdm
+from agent import Agent, RandomAgent, WalkThroughAgent
 
 
 def get_game_name(game_path: str) -> str:
@@ -20,6 +25,90 @@ def get_game_name(game_path: str) -> str:
     return game_name
 
 
+def get_result(
+    game_path: str, agent: Agent, max_score: int, walkthrough_length: int
+) -> dict:
+    """
+    Summarizes a finished game.
+
+    Args:
+        game_path (str): The path to the game file.
+        agent (Agent): The agent that played the game.
+        max_score (int): The maximum score of the game.
+        walkthrough_length (int): The length of the game's walkthrough.
+    Returns:
+        result (dict): The result of the game.
+    """
+    import numpy as np
+
+    return {
+        "agent": agent.__class__.__name__,
+        "game_path": game_path,
+        "max_steps": agent.max_steps,
+        "steps": agent.step,
+        "num_observations": len(agent.observations),
+        "num_actions": len(agent.actions),
+        "num_rewards": len(agent.rewards),
+        "total_reward": np.asarray(agent.rewards).sum().item(),
+        "max_score": max_score,
+        "walkthrough_length": walkthrough_length,
+        "info": agent.info,
+    }
+
+
+def run_game(game_path: str, agent_type: str, max_steps: int | None) -> dict:
+    """
+    Runs a RandomAgent or WalkThroughAgent on a single game. This is a top-level
+    function so that it can be run in a worker process.
+
+    Args:
+        game_path (str): The path to the game file.
+        agent_type (str): The type of agent to use.
+        max_steps (int): The maximum number of steps for the game.
+    Returns:
+        result (dict): The result of the game.
+    """
+    env = create_game(game_path)
+    # The environment is closed at the end of the run, so query it beforehand
+    max_score = env.get_max_score()
+    walkthrough_length = len(env.get_walkthrough())
+
+    if agent_type == "RandomAgent":
+        agent = RandomAgent(env, max_steps=max_steps)
+    elif agent_type == "WalkThroughAgent":
+        agent = WalkThroughAgent(env, max_steps=max_steps)
+    else:
+        raise ValueError(f"Unknown agent type: {agent_type}")
+
+    agent.run()
+
+    return get_result(game_path, agent, max_score, walkthrough_length)
+
+
+def run_games_in_parallel(
+    game_paths: list[str], agent_type: str, max_steps: int | None, num_workers: int
+) -> Iterator[dict]:
+    """
+    Runs a RandomAgent or WalkThroughAgent on each game in a pool of processes.
+
+    Args:
+        game_paths (list[str]): The paths to the game files.
+        agent_type (str): The type of agent to use.
+        max_steps (int): The maximum number of steps for each game.
+        num_workers (int): The number of worker processes. If None, the number of
+            CPUs is used.
+    Yields:
+        result (dict): The result of each game, as soon as it has finished.
+    """
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(run_game, game_path, agent_type, max_steps)
+            for game_path in game_paths
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
 def run_games(
     agent_type="RandomAgent",
     max_steps=None,
@@ -30,6 +119,10 @@ def run_games(
     max_chat_history_size=10,
     fallback_to_random=True,
     timeout=10,
+    max_concurrency=16,
+    num_workers=None,
+    use_action_cache=False,
+    max_archived_observation_length=400,
 ) -> None:
     """
     Runs a specified agent on a set of games and saves the results to a JSON file.
@@ -39,81 +132,124 @@ def run_games(
         max_steps (int): The maximum number of steps for each game (default: None).
         only_33 (bool): Whether to only use the games in the '33' set (default: True).
         output_file (str): The name of the file to save the results to (default:
-            "results.json").
+            "results.json"). As each game finishes, its result is also appended to
+            a JSON Lines file next to it (e.g. "results.partial.jsonl"), so that
+            finished games are not lost if the run crashes.
         api_key (str): The API key for the LLMAgent (default: None).
         model (str): The model to use for the LLMAgent (default: None).
-        max_chat_history_size (int): The maximum chat history size for the LLMAgent
-            (default: 10).
+        max_chat_history_size (int): The maximum chat history size for the LLMAgent.
+            Must be at least 1 (default: 10).
         fallback_to_random (bool): Whether to fallback to random for the LLMAgent
             (default: True).
         timeout (int): The timeout for the LLMAgent (default: 10).
+        max_concurrency (int): The maximum number of concurrent API requests when
+            running LLMAgents (default: 16).
+        num_workers (int): The number of worker processes for the other agents
+            (default: None, i.e. the number of CPUs).
+        use_action_cache (bool): Whether the LLMAgent reuses its previous choice for
+            a repeated game state instead of querying the LLM (default: False).
+        max_archived_observation_length (int): The number of characters that past
+            observations are cut down to in the LLMAgent's chat history. If None,
+            they are kept in full (default: 400).
 
     """
 
     game_paths = get_game_paths(only_33=only_33)
 
+    if agent_type == "LLMAgent" and (not api_key or not model):
+        raise ValueError("API key and model must be specified for LLMAgent")
+
     results = {}
-    for game_path in tqdm(game_paths, desc="Running games"):
-        env = create_game(game_path)
-
-        if agent_type == "RandomAgent":
-            agent = RandomAgent(env, max_steps=max_steps)
-        elif agent_type == "WalkThroughAgent":
-            agent = WalkThroughAgent(env, max_steps=max_steps)
-        elif agent_type == "LLMAgent":
-            if not api_key or not model:
-                raise ValueError("API key and model must be specified for LLMAgent")
-            agent = LLMAgent(
-                api_key=api_key,
-                model=model,
-                env=env,
-                max_steps=max_steps,
-                max_chat_history_size=max_chat_history_size,
-                fallback_to_random=fallback_to_random,
-                timeout=timeout,
+    partial_output_file = os.path.splitext(output_file)[0] + ".partial.jsonl"
+    with open(partial_output_file, "w", encoding="utf-8") as partial_f, tqdm(
+        total=len(game_paths),
+        desc="Running games",
+        disable=not sys.stdout.isatty(),
+    ) as progress_bar:
+
+        def save_result(result: dict) -> None:
+            game_path = result["game_path"]
+            results[get_game_name(game_path)] = result
+
+            print(f"Game: {game_path}")
+            print(f"  Agent: {result['agent']}")
+            print(f"  Max Steps: {result['max_steps']}")
+            print(f"  Steps: {result['steps']}")
+            print(f"  Observations: {result['num_observations']}")
+            print(f"  Actions: {result['num_actions']}")
+            print(f"  Rewards: {result['num_rewards']}")
+            print(f"  Total Reward: {result['total_reward']}")
+            print(f"  Max Score: {result['max_score']}")
+            print(f"  Walkthrough length: {result['walkthrough_length']}")
+            print(f"  Info: {result['info']}")
+            print()
+
+            partial_f.write(json.dumps({get_game_name(game_path): result}) + "\n")
+            partial_f.flush()
+            progress_bar.update()
+
+        if agent_type == "LLMAgent":
+            from agent import BatchLLMDriver, LLMAgent
+
+            # LLM agents spend most of their time waiting on the API, so all games
+            # are played in lockstep: the requests of each step are sent together,
+            # and the games are stepped together in parallel threads.
+            envs = [create_game(game_path) for game_path in game_paths]
+            # The environments are closed at the end of the run, so query them
+            # beforehand
+            max_scores = [env.get_max_score() for env in envs]
+            walkthrough_lengths = [len(env.get_walkthrough()) for env in envs]
+            agents = [
+                LLMAgent(
+                    api_key=api_key,
+                    model=model,
+                    env=env,
+                    max_steps=max_steps,
+                    max_chat_history_size=max_chat_history_size,
+                    fallback_to_random=fallback_to_random,
+                    timeout=timeout,
+                    use_action_cache=use_action_cache,
+                    max_archived_observation_length=max_archived_observation_length,
+                )
+                for env in envs
+            ]
+            vector_env = VectorFrotzEnv(envs)
+            driver = BatchLLMDriver(timeout=timeout, max_concurrency=max_concurrency)
+            asyncio.run(
+                driver.run(
+                    agents,
+                    vector_env,
+                    on_finish=lambda index: save_result(
+                        get_result(
+                            game_paths[index],
+                            agents[index],
+                            max_scores[index],
+                            walkthrough_lengths[index],
+                        )
+                    ),
+                )
             )
+            vector_env.close()
         else:
-            raise ValueError(f"Unknown agent type: {agent_type}")
-
-        agent.run()
-
-        num_observations = len(agent.observations)
-        num_actions = len(agent.actions)
-        num_rewards = len(agent.rewards)
-        total_reward = sum(agent.rewards.values())
-
-        result = {
-            "agent": agent.__class__.__name__,
-            "game_path": game_path,
-            "max_steps": agent.max_steps,
-            "steps": agent.step,
-            "num_observations": num_observations,
-            "num_actions": num_actions,
-            "num_rewards": num_rewards,
-            "total_reward": total_reward,
-            "max_score": env.get_max_score(),
-            "info": agent.info,
-        }
-        results[get_game_name(game_path)] = result
-
-        print(f"Game: {game_path}")
-        print(f"  Agent: {agent.__class__.__name__}")
-        print(f"  Max Steps: {agent.max_steps}")
-        print(f"  Steps: {agent.step}")
-        print(f"  Observations: {num_observations}")
-        print(f"  Actions: {num_actions}")
-        print(f"  Rewards: {num_rewards}")
-        print(f"  Total Reward: {total_reward}")
-        print(f"  Max Score: {env.get_max_score()}")
-        print(f"  Walkthrough length: {len(env.get_walkthrough())}")
-        print(f"  Info: {agent.info}")
-        print()
-
-        # Save the results to a JSON file
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(results, f, indent=4)
-
-        print(f"Results saved to {output_file}")
+            # The other agents are CPU-bound and the games are independent, so they
+            # are played in parallel processes.
+            for result in run_games_in_parallel(
+                game_paths, agent_type, max_steps, num_workers
+            ):
+                save_result(result)
+
+    # Games finish in any order, so restore the order of game_paths
+    results = {
+        game_name: results[game_name]
+        for game_name in map(get_game_name, game_paths)
+        if game_name in results
+    }
+
+    # Save the results to a JSON file
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+
+    print(f"Results saved to {output_file}")
 
 
 if __name__ == "__main__":
@@ -153,9 +289,9 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--max_chat_history_size",
-        type=str,
+        type=int,
         default=10,
-        help="The maximum chat history size for the LLMAgent.",
+        help="The maximum chat history size for the LLMAgent (at least 1).",
     )
     parser.add_argument(
         "--fallback_to_random",
@@ -169,8 +305,36 @@ if __name__ == "__main__":
         default=10,
         help="The timeout for the LLMAgent.",
     )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=16,
+        help="The maximum number of concurrent API requests for the LLMAgent.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="The number of worker processes for the other agents.",
+    )
+    parser.add_argument(
+        "--use_cache",
+        action="store_true",
+        help="Let the LLMAgent reuse its previous choice for a repeated game state.",
+    )
+    parser.add_argument(
+        "--max_archived_observation_length",
+        type=int,
+        default=400,
+        help=(
+            "The number of characters past observations are cut down to. "
+            "0 or less keeps them in full."
+        ),
+    )
 
     args = parser.parse_args()
+    if args.max_chat_history_size < 1:
+        parser.error("--max_chat_history_size must be at least 1")
 
     run_games(
         args.agent_type,
@@ -182,4 +346,12 @@ if __name__ == "__main__":
         args.max_chat_history_size,
         args.fallback_to_random,
         args.timeout,
+        args.max_concurrency,
+        args.num_workers,
+        args.use_cache,
+        (
+            args.max_archived_observation_length
+            if args.max_archived_observation_length > 0
+            else None
+        ),
     )
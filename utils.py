@@ -2,8 +2,48 @@
 Utility functions for the agent.
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from jericho import FrotzEnv
+
+# The 33 games used in the paper
+POSSIBLE_GAMES = frozenset(
+    {
+        "905",
+        "acorncourt",
+        "advent",
+        "adventureland",
+        "afflicted",
+        "anchor",
+        "awaken",
+        "balances",
+        "deephome",
+        "detective",
+        "dragon",
+        "enchanter",
+        "gold",
+        "inhumane",
+        "jewel",
+        "karn",
+        "library",
+        "ludicorp",
+        "moonlit",
+        "omniquest",
+        "pentari",
+        "reverb",
+        "snacktime",
+        "sorcerer",
+        "spellbrkr",
+        "spirit",
+        "temple",
+        "tryst205",
+        "yomomma",
+        "zenon",
+        "zork1",
+        "zork3",
+        "ztuu",
+    }
+)
 
 
 def get_game_paths(only_33=True) -> list:
@@ -19,45 +59,10 @@ def get_game_paths(only_33=True) -> list:
     game_paths = glob("./z-machine-games-master/jericho-game-suite/*")
 
     if only_33:
-        possible_games = [
-            "905",
-            "acorncourt",
-            "advent",
-            "adventureland",
-            "afflicted",
-            "anchor",
-            "awaken",
-            "balances",
-            "deephome",
-            "detective",
-            "dragon",
-            "enchanter",
-            "gold",
-            "inhumane",
-            "jewel",
-            "karn",
-            "library",
-            "ludicorp",
-            "moonlit",
-            "omniquest",
-            "pentari",
-            "reverb",
-            "snacktime",
-            "sorcerer",
-            "spellbrkr",
-            "spirit",
-            "temple",
-            "tryst205",
-            "yomomma",
-            "zenon",
-            "zork1",
-            "zork3",
-            "ztuu",
-        ]
         game_paths = [
             game_path
             for game_path in game_paths
-            if game_path.split("/")[-1].split(".")[0] in possible_games
+            if os.path.splitext(os.path.basename(game_path))[0] in POSSIBLE_GAMES
         ]
 
     return game_paths
@@ -67,4 +72,64 @@ def create_game(game_path: str):
     """
     Returns a Jericho FrotzEnv game instance given the path to the game.
     """
+    from jericho import FrotzEnv
+
     return FrotzEnv(game_path)
+
+
+class VectorFrotzEnv:
+    """
+    Queries and steps several FrotzEnv games in parallel threads.
+
+    Jericho calls into the Frotz C library through ctypes, which releases the GIL for
+    the duration of each call, so independent games can advance at the same time.
+    The environments stay owned by their agents, which are responsible for closing
+    them.
+    """
+
+    def __init__(self, envs: list) -> None:
+        """
+        Args:
+            envs (list[FrotzEnv]): The environments to wrap.
+        """
+        self.envs = envs
+        self._executor = ThreadPoolExecutor(max_workers=max(len(envs), 1))
+
+    def get_valid_actions(self, indices: list[int]) -> list[list[str]]:
+        """
+        Returns the valid actions of the selected environments.
+
+        Args:
+            indices (list[int]): The indices of the environments to query.
+        Returns:
+            valid_actions (list[list[str]]): The valid actions of each environment,
+                in the order of indices.
+        """
+        return list(
+            self._executor.map(
+                lambda index: self.envs[index].get_valid_actions(), indices
+            )
+        )
+
+    def step(self, indices: list[int], actions: list[str]) -> list[tuple]:
+        """
+        Takes one action in each of the selected environments.
+
+        Args:
+            indices (list[int]): The indices of the environments to step.
+            actions (list[str]): The action to take in each environment.
+        Returns:
+            results (list[tuple]): The (observation, reward, done, info) of each
+                environment, in the order of indices.
+        """
+        return list(
+            self._executor.map(
+                lambda index, action: self.envs[index].step(action), indices, actions
+            )
+        )
+
+    def close(self) -> None:
+        """
+        Shuts down the worker threads. The environments are left as they are.
+        """
+        self._executor.shutdown()